@@ -3,8 +3,9 @@ import streamlit as st
 import fitz  # PyMuPDF
 import io
 import base64
+import functools
 import os
-import html
+import re
 from PIL import Image
 
 # Optional OCR
@@ -14,31 +15,84 @@ try:
 except Exception:
     OCR_AVAILABLE = False
 
+# Pages rendered into the on-screen preview; the download always has every page
+PREVIEW_PAGE_LIMIT = 20
+
+# Cached layouts hold every rendered page image, so keep only the most recent
+# few document/DPI combinations in memory
+LAYOUT_CACHE_ENTRIES = 8
+
 st.set_page_config(page_title="Legal Judgment PDF → HTML ", layout="wide")
 
 # ---------- Helpers ----------
-def to_data_url(pix):
-    """Return a PNG data URL from a PyMuPDF Pixmap."""
-    img_bytes = pix.tobytes("png")
-    b64 = base64.b64encode(img_bytes).decode('ascii')
+def _minify_css(css):
+    """Strip comments and collapse whitespace in a CSS string."""
+    css = re.sub(r'/\*.*?\*/', '', css, flags=re.S)
+    css = re.sub(r'\s+', ' ', css)
+    css = re.sub(r'\s*([{}:;,>])\s*', r'\1', css)
+    return css.strip()
+
+# Static page CSS, minified once at import instead of on every export
+_BASE_CSS = _minify_css("""
+body { background:#ececec; margin:0; font-family: Georgia, 'Times New Roman', serif; }
+.viewer { display:flex; flex-direction:column; align-items:center; gap:20px; padding:20px; }
+.pdf-page { box-shadow:0 6px 18px rgba(0,0,0,0.12); background-color:white; }
+.text-span { color: rgba(0,0,0,0.98); }
+""")
+
+# Default "dict" flags minus TEXT_PRESERVE_IMAGES: only text blocks are used
+_TEXT_DICT_FLAGS = fitz.TEXTFLAGS_DICT & ~fitz.TEXT_PRESERVE_IMAGES
+
+# Same escaping as html.escape(quote=True) plus newline -> <br/>, in one pass
+_HTML_ESCAPE_TABLE = str.maketrans({
+    '&': '&amp;', '<': '&lt;', '>': '&gt;', '"': '&quot;', "'": '&#x27;', '\n': '<br/>',
+})
+
+def to_data_url(png_bytes):
+    """Return a PNG data URL from raw PNG bytes."""
+    b64 = base64.b64encode(png_bytes).decode('ascii')
     return f"data:image/png;base64,{b64}"
 
+# Streamlit reruns the script on every widget change; the heavy helpers are
+# cached on their inputs so a rerun with the same PDF is a lookup, not a re-parse.
+@st.cache_data(show_spinner=False)
+def has_text_layer(pdf_bytes, sample_pages=3, min_chars=20):
+    """
+    Cheap probe: return True if the first few pages carry embedded text.
+    Only used to warn that a PDF looks scanned; extraction always runs in full.
+    """
+    doc = fitz.open(stream=pdf_bytes, filetype="pdf")
+    try:
+        found = 0
+        for i in range(min(sample_pages, doc.page_count)):
+            # flags=0: only the character count matters, skip ligature/whitespace handling
+            found += len(doc[i].get_text('text', flags=0).strip())
+            if found >= min_chars:
+                return True
+        return False
+    finally:
+        doc.close()
+
+@st.cache_data(show_spinner=False, max_entries=LAYOUT_CACHE_ENTRIES)
 def extract_layout_pages(pdf_bytes, render_dpi=150):
     """
     Extract page images and exact text spans (with positions and font info).
-    Returns list of pages: {width_px, height_px, img, spans: [{x,y,w,h,text,font,size}]}
+    Returns list of pages: {width_px, height_px, png, spans: [{x,y,w,h,text,font,size}]}
+    `png` holds the raw rendered PNG bytes; they are only base64-encoded when
+    the HTML is generated, so OCR can read them without a data-URL round trip.
     Coordinates are in pixels with origin at top-left matching the rendered image.
     """
     doc = fitz.open(stream=pdf_bytes, filetype="pdf")
     scale = render_dpi / 72.0
+    mat = fitz.Matrix(scale, scale)
     pages = []
     for p in doc:
-        mat = fitz.Matrix(scale, scale)
         pix = p.get_pixmap(matrix=mat, alpha=False)
-        img_url = to_data_url(pix)
+        png_bytes = pix.tobytes("png")
         pw, ph = pix.width, pix.height
 
-        page_dict = p.get_text("dict")
+        # image blocks are skipped below anyway, so don't have MuPDF decode them
+        page_dict = p.get_text("dict", flags=_TEXT_DICT_FLAGS)
         spans_list = []
         # iterate blocks -> lines -> spans so we preserve exact positions
         for block in page_dict.get('blocks', []):
@@ -46,6 +100,10 @@ def extract_layout_pages(pdf_bytes, render_dpi=150):
                 continue
             for line in block.get('lines', []):
                 for span in line.get('spans', []):
+                    text = span.get('text', '')
+                    if not text:
+                        # empty spans are never rendered; don't carry them into the cache
+                        continue
                     bbox = span.get('bbox', [0,0,0,0])
                     x0, y0, x1, y1 = bbox
                     # Convert from points to rendered pixels using same scale factor
@@ -53,7 +111,6 @@ def extract_layout_pages(pdf_bytes, render_dpi=150):
                     y_px = y0 * scale
                     w_px = max(1, (x1 - x0) * scale)
                     h_px = max(1, (y1 - y0) * scale)
-                    text = span.get('text', '')
                     size = span.get('size', 0)
                     font = span.get('font', '')
                     flags = span.get('flags', 0)
@@ -61,34 +118,42 @@ def extract_layout_pages(pdf_bytes, render_dpi=150):
                         'x': x_px, 'y': y_px, 'w': w_px, 'h': h_px,
                         'text': text, 'font': font, 'size': size, 'flags': flags
                     })
-        pages.append({'width_px': pw, 'height_px': ph, 'img': img_url, 'spans': spans_list})
+        pages.append({'width_px': pw, 'height_px': ph, 'png': png_bytes, 'spans': spans_list})
     doc.close()
     return pages
 
-def generate_high_fidelity_html(pages, include_image=True, fonts_dict=None):
+@st.cache_data(show_spinner=False)
+def ocr_page_spans(png_bytes):
     """
-    Generate HTML with page images as background and absolutely positioned spans on top.
-    include_image: whether to include the original rendered image as background.
-    fonts_dict: optional dict map fontname->base64-ttf to embed via @font-face.
+    OCR a rendered page and return word spans in the same shape as extract_layout_pages.
+    Tesseract's column lists are walked together in one zip pass rather than by index.
     """
-    pages_html = []
+    img = Image.open(io.BytesIO(png_bytes)).convert('RGB')
+    data = pytesseract.image_to_data(img, output_type=pytesseract.Output.DICT)
+    return [
+        {'x': x, 'y': y, 'w': w, 'h': h, 'text': txt, 'font': 'OCR', 'size': h}
+        for txt, x, y, w, h in zip(data['text'], data['left'], data['top'], data['width'], data['height'])
+        if txt.strip()
+    ]
 
-    # optional @font-face blocks
-    font_faces = []
-    if fonts_dict:
-        for fname, b64 in fonts_dict.items():
-            safe_name = fname.replace(' ', '_')
-            face = (
-                "@font-face {"
-                f"font-family: '{safe_name}';"
-                f"src: url(data:font/ttf;charset=utf-8;base64,{b64}) format('truetype');"
-                "font-weight: normal;"
-                "font-style: normal;"
-                "}"
-            )
-            font_faces.append(face)
-    font_css = "\n".join(font_faces)
+@functools.lru_cache(maxsize=256)
+def _font_family_css(font):
+    """
+    Derive a CSS font-family declaration from a PyMuPDF font name.
+    A document uses only a handful of fonts, so this is computed once per name
+    instead of once per span.
+    """
+    font_family = font.split('+')[-1].split('-')[0] if font else 'serif'
+    return f"font-family: '{font_family}', serif;"
 
+def render_page_fragments(pages, include_image=True):
+    """
+    Render each page to its own HTML fragment: a .pdf-page container with the
+    page image as background and absolutely positioned spans on top.
+    The full export and the bounded preview are both assembled from the same
+    fragments within a run, so no page is rendered twice.
+    """
+    fragments = []
     for p in pages:
         # container matches rendered image size
         w = p['width_px']
@@ -96,20 +161,18 @@ def generate_high_fidelity_html(pages, include_image=True, fonts_dict=None):
         bg_style = ''
         if include_image:
             # safe-quote URL inside single quotes
-            bg_style = f"background-image:url('{p['img']}'); background-size: {w}px {h}px; background-repeat:no-repeat;"
-        # Build spans HTML. Each span in its own div to preserve exact placement.
-        spans_html = []
+            bg_style = f"background-image:url('{to_data_url(p['png'])}'); background-size: {w}px {h}px; background-repeat:no-repeat;"
+        parts = [f"<div class='pdf-page' style='position:relative; width:{w}px; height:{h}px; {bg_style}'>\n"]
+        # Each span in its own div to preserve exact placement.
         for s in p['spans']:
             if not s['text']:
                 continue
-            # sanitize text but keep whitespace/newlines converted
-            content = html.escape(s['text']).replace('\n', '<br/>')
+            # sanitize text but keep whitespace/newlines converted (single pass)
+            content = s['text'].translate(_HTML_ESCAPE_TABLE)
             # Heuristic: font-size about 90% of span height
             font_px = max(6, s['h'] * 0.9)
 
-            # derive a simple font-family from PyMuPDF font name
-            font_family = s['font'].split('+')[-1].split('-')[0] if s['font'] else 'serif'
-            font_family_css = f"font-family: '{font_family}', serif;"
+            font_family_css = _font_family_css(s['font'])
 
             span_style = (
                 f"position:absolute; left:{s['x']:.2f}px; top:{s['y']:.2f}px; "
@@ -117,44 +180,76 @@ def generate_high_fidelity_html(pages, include_image=True, fonts_dict=None):
                 f"font-size:{font_px:.2f}px; line-height:1; {font_family_css} "
                 "white-space:pre; overflow:hidden;"
             )
-            span_html = f"<div class=\"text-span\" style=\"{span_style}\">{content}</div>"
-            spans_html.append(span_html)
-
-        page_html = (
-            f"<div class='pdf-page' style='position:relative; width:{w}px; height:{h}px; {bg_style}'>\n"
-            f"{''.join(spans_html)}\n"
-            f"</div>\n"
-        )
-        pages_html.append(page_html)
-
-    css = (
-        "<style>\n"
-        f"{font_css}\n"
-        "body { background:#ececec; margin:0; font-family: Georgia, 'Times New Roman', serif; }\n"
-        ".viewer { display:flex; flex-direction:column; align-items:center; gap:20px; padding:20px; }\n"
-        ".pdf-page { box-shadow:0 6px 18px rgba(0,0,0,0.12); background-color:white; }\n"
-        ".text-span { color: rgba(0,0,0,0.98); }\n"
-        "</style>\n"
-    )
+            parts.append(f"<div class=\"text-span\" style=\"{span_style}\">{content}</div>")
+        parts.append("\n</div>\n")
+        fragments.append("".join(parts))
+    return fragments
+
+def assemble_html(page_fragments, fonts_dict=None):
+    """
+    Wrap rendered page fragments in the export document.
+    fonts_dict: optional dict map fontname->base64-ttf to embed via @font-face.
+    """
+    # optional @font-face blocks
+    font_faces = []
+    if fonts_dict:
+        for fname, b64 in fonts_dict.items():
+            safe_name = fname.replace(' ', '_')
+            face = (
+                "@font-face {"
+                f"font-family: '{safe_name}';"
+                f"src: url(data:font/ttf;charset=utf-8;base64,{b64}) format('truetype');"
+                "font-weight: normal;"
+                "font-style: normal;"
+                "}"
+            )
+            font_faces.append(face)
+    font_css = "".join(font_faces)
+
+    css = f"<style>{font_css}{_BASE_CSS}</style>\n"
 
-    html_full = (
+    # Collect everything into one list and join once at the end
+    parts = [
         "<!doctype html>\n"
         "<html>\n"
         "<head>\n"
         "<meta charset='utf-8'/>\n"
-        "<title>High-fidelity Judgment Export</title>\n"
-        f"{css}\n"
+        "<title>High-fidelity Judgment Export</title>\n",
+        css,
+        "\n"
         "</head>\n"
         "<body>\n"
-        "<div class='viewer'>\n"
-        f"{''.join(pages_html)}\n"
+        "<div class='viewer'>\n",
+    ]
+    parts.extend(page_fragments)
+    parts.append(
+        "\n"
         "</div>\n"
         "</body>\n"
         "</html>\n"
     )
-    return html_full
+    return "".join(parts)
 
 # ---------- Streamlit UI ----------
+@st.fragment
+def show_results(page_fragments, html_out, fonts_dict, export_name):
+    """
+    Download and preview section. Runs as a fragment so the preview toggle and
+    the download click rerun only this block, not the whole script.
+    """
+    # Offer the download first so it is usable before the preview iframe renders
+    st.download_button("Download HTML", data=html_out.encode('utf-8'),
+                       file_name=export_name, mime='text/html')
+
+    st.subheader("Preview")
+    preview_html = html_out
+    if len(page_fragments) > PREVIEW_PAGE_LIMIT:
+        show_all = st.checkbox(f"Preview all {len(page_fragments)} pages (may be slow)", value=False)
+        if not show_all:
+            st.caption(f"Showing the first {PREVIEW_PAGE_LIMIT} of {len(page_fragments)} pages — download for the full export.")
+            preview_html = assemble_html(page_fragments[:PREVIEW_PAGE_LIMIT], fonts_dict=fonts_dict)
+    st.components.v1.html(preview_html, height=900, scrolling=True)
+
 st.title(" Judgment PDF → HTML")
 st.markdown(
     """
@@ -171,11 +266,16 @@ use_ocr = st.checkbox("Force OCR (if PDF is scanned)", value=False)
 uploaded_fonts = st.file_uploader("Upload .ttf font files (optional, multiple)", type=["ttf"], accept_multiple_files=True)
 
 if uploaded is not None:
-    pdf_bytes = uploaded.read()
+    # getvalue() returns the whole buffer regardless of stream position, so a
+    # rerun never sees an already-consumed upload
+    pdf_bytes = uploaded.getvalue()
     st.info(f"Processing {uploaded.name} — {len(pdf_bytes):,} bytes")
 
     with st.spinner("Extracting pages and layout (PyMuPDF)..."):
         try:
+            if not use_ocr and not has_text_layer(pdf_bytes):
+                hint = " Enable 'Force OCR' to recover text." if OCR_AVAILABLE else ""
+                st.warning(f"No embedded text found on the first pages — this looks like a scanned PDF.{hint}")
             pages = extract_layout_pages(pdf_bytes, render_dpi=render_dpi)
             total_spans = sum(len(p['spans']) for p in pages)
             if total_spans == 0 and (use_ocr or (not pages)) and OCR_AVAILABLE:
@@ -183,23 +283,8 @@ if uploaded is not None:
                 # do simple OCR per rendered image
                 ocr_pages = []
                 for p in pages:
-                    # decode image from data url
-                    header, b64 = p['img'].split(',', 1)
-                    img_bytes = base64.b64decode(b64)
-                    img = Image.open(io.BytesIO(img_bytes)).convert('RGB')
-                    data = pytesseract.image_to_data(img, output_type=pytesseract.Output.DICT)
-                    spans = []
-                    n = len(data['text'])
-                    for i in range(n):
-                        txt = data['text'][i]
-                        if not txt.strip():
-                            continue
-                        x = data['left'][i]
-                        y = data['top'][i]
-                        w = data['width'][i]
-                        h = data['height'][i]
-                        spans.append({'x': x, 'y': y, 'w': w, 'h': h, 'text': txt, 'font': 'OCR', 'size': h})
-                    ocr_pages.append({'width_px': p['width_px'], 'height_px': p['height_px'], 'img': p['img'], 'spans': spans})
+                    spans = ocr_page_spans(p['png'])
+                    ocr_pages.append({'width_px': p['width_px'], 'height_px': p['height_px'], 'png': p['png'], 'spans': spans})
                 pages = ocr_pages
             elif total_spans == 0 and use_ocr and not OCR_AVAILABLE:
                 st.error('OCR requested but pytesseract not available in this environment.')
@@ -212,18 +297,16 @@ if uploaded is not None:
     if uploaded_fonts:
         for f in uploaded_fonts:
             name = os.path.splitext(f.name)[0]
-            b64 = base64.b64encode(f.read()).decode('ascii')
+            b64 = base64.b64encode(f.getvalue()).decode('ascii')
             fonts_dict[name] = b64
 
     # Generate HTML
     with st.spinner("Generating  HTML..."):
-        html_out = generate_high_fidelity_html(pages, include_image=include_image, fonts_dict=fonts_dict if fonts_dict else None)
+        page_fragments = render_page_fragments(pages, include_image=include_image)
+        html_out = assemble_html(page_fragments, fonts_dict=fonts_dict if fonts_dict else None)
 
-    st.subheader("Preview")
-    st.components.v1.html(html_out, height=900, scrolling=True)
-
-    st.download_button("Download HTML", data=html_out.encode('utf-8'),
-                       file_name=os.path.splitext(uploaded.name)[0] + "_export.html", mime='text/html')
+    export_name = os.path.splitext(uploaded.name)[0] + "_export.html"
+    show_results(page_fragments, html_out, fonts_dict if fonts_dict else None, export_name)
 
     st.markdown("---")
     st.markdown("**If you want a closer match:**\n\n- Upload original TTF fonts used by the court (if available).\n- Increase Render DPI to 200-300.\n- If you need absolute pixel perfection for a small set of courts, share sample PDFs and I'll tune CSS and font mappings specifically for those templates.")